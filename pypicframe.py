@@ -24,20 +24,36 @@
 """Smart Picture Frame software for the Raspberry Pi and similar SBCs"""
 from __future__ import print_function
 import sys
+import atexit
 import random as rand
 import os
+import errno
+import fcntl
 import json
 import subprocess
 import time
 import shutil
-from Xlib.display import Display
-from ctypes import cdll, byref, create_string_buffer
-import psutil
+import tempfile
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import (CDLL, byref, create_string_buffer, get_errno,
+                    c_char_p, c_int, c_ulong, c_void_p)
+import pyudev
 import gi
 
 gi.require_version('Gtk', '3.0')
 
-from gi.repository import Gtk, GdkPixbuf, GLib
+from gi.repository import Gtk, Gdk, GdkPixbuf, GLib
+try:
+    # orjson parses in C, and is several times faster than json
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        """Serialize obj to JSON bytes, the same as orjson.dumps"""
+        return json.dumps(obj).encode()
 
 
 def __eprint__(*args, **kwargs):
@@ -50,64 +66,73 @@ if sys.version_info[0] == 2:
     sys.exit(2)
 
 
+@functools.cache
+def _load_settings():
+    """Read the internal settings file. It never changes at runtime, so only
+    do this once.
+    """
+    for each in ("/etc/pypicframe/internal_settings.json", "internal_settings.json"):
+        if os.path.exists(each):
+            try:
+                with open(each, "rb") as file:
+                    return json_loads(file.read())
+            except json.decoder.JSONDecodeError:
+                print("Error Reading Internal Settings File. Defaulting internal backups...")
+            break
+    else:
+        print("Cannot Find Internal Settings File. Defaulting internal backups...")
+    # fall back to these if we can't read the internal settings file
+    return {
+                "part": "/dev/sde1",
+                "logfile": "./pypicframe.log",
+                "cache_size": 16
+            }
+
+
+settings = _load_settings()
+part = settings["part"]
+logfile = settings["logfile"]
+
+
+# keep the log open for the life of the process, rather than opening it for
+# every line. Line buffered, so nothing is lost if we get killed.
 try:
-    try:
-        with open("/etc/pypicframe/internal_settings.json", "r") as file:
-            settings = json.load(file)
-    except FileNotFoundError:
-        try:
-            with open("internal_settings.json", "r") as file:
-                settings = json.load(file)
-        except FileNotFoundError:
-            print("Cannot Find Internal Settings File. Defaulting internal backups...")
-            settings = {
-                            "part": "/dev/sde1",
-                            "logfile": "./pypicframe.log"
-                        }
-    part = settings["part"]
-    logfile = settings["logfile"]
-except json.decoder.JSONDecodeError:
-    print("Error Reading Internal Settings File. Defaulting internal backups...")
-    settings = {
-                            "part": "/dev/sde1",
-                            "logfile": "./pypicframe.log"
-                        }
-    part = settings["part"]
-    logfile = settings["logfile"]
-    override = 0
+    log_file = open(logfile, "a", buffering=1)
+except PermissionError:
+    log_file = open("./pypicframe.log", "a", buffering=1)
+atexit.register(log_file.close)
 
 
 def log(output):
     """Print log data to STDOUT and log file"""
-    try:
-        global logfile
-    except NameError:
-        try:
-            with open("/etc/pypicframe/internal_settings.json", "r") as file:
-                settings = json.load(file)
-        except FileNotFoundError:
-            try:
-                with open("internal_settings.json", "r") as file:
-                    settings = json.load(file)
-            except FileNotFoundError:
-                settings = {
-                                "part": "/dev/sde1",
-                                "logfile": "./pypicframe.log"
-                            }
-        logfile = settings["logfile"]
-    try:
-        with open(logfile, "a+") as file:
-            file.write(output)
-            file.write("\n")
-    except PermissionError:
-        with open("./pypicframe.log", "a+") as file:
-            file.write(output)
-            file.write("\n")
+    log_file.write(f"{output}\n")
     print(output)
 
 
 # supported file types
-file_types = ("jpg", "jpeg", "jpe", "png", "svg", "gif", "tif", "tiff")
+file_types = frozenset(("jpg", "jpeg", "jpe", "png", "svg", "gif", "tif", "tiff"))
+file_suffixes = tuple("." + each for each in file_types)
+
+# rating folders, from least to most shown, and where they live on the drive
+buckets = ("x", "xx", "xxx", "xxxx", "xxxxx")
+bucket_dirs = tuple(f"/mnt/{each}/" for each in buckets)
+
+# a slideshow needs at least this many pictures. Anything less and we wait for more.
+min_pics = 2
+
+# filesystems to try, in order, when mounting the drive with mount(2)
+mount_fstypes = ("vfat", "exfat", "ntfs3", "ext4")
+
+# where the image index is kept between runs
+index_cache = "/var/cache/pypicframe/index.json"
+# vfat only keeps folder mtimes to the nearest 2 seconds, so a folder changed
+# within this long of a scan might not look changed to the next one
+mtime_granularity = 2_000_000_000
+
+# one handle on libc for everything we call directly
+libc = CDLL("libc.so.6", use_errno=True)
+libc.mount.argtypes = (c_char_p, c_char_p, c_char_p, c_ulong, c_void_p)
+libc.umount2.argtypes = (c_char_p, c_int)
 
 # check to make sure we are running in a good place
 ls = os.listdir()
@@ -123,410 +148,665 @@ if "errors" not in ls:
 
 def set_procname(newname):
     """set procname for current process"""
-    libc = cdll.LoadLibrary('libc.so.6')    #Loading a 3rd party library C
     buff = create_string_buffer(len(newname) + 1) #Note: One larger than the name (man prctl says that)
     buff.value = bytes(newname, 'utf-8')               #Null terminated string as it should be
     libc.prctl(15, byref(buff), 0, 0, 0) #Refer to "#define" of "/usr/include/linux/prctl.h" for the misterious value 16 & arg[3..5] are zero as the man page says.
 
 
+def load_json(path):
+    """Parse a JSON file, reusing the last parse if it hasn't changed since
+
+    Hands back the same dict each time, so copy it before changing anything.
+    """
+    return _load_json_by_mtime(path, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_json_by_mtime(path, mtime_ns):
+    """Parse a JSON file. mtime_ns is only here to key the cache on."""
+    with open(path, "rb") as file:
+        return json_loads(file.read())
+
+
+def read_index_cache():
+    """Read the image index saved by a previous run"""
+    try:
+        with open(index_cache, "rb") as file:
+            cache = json_loads(file.read())
+    except (FileNotFoundError, PermissionError, json.decoder.JSONDecodeError):
+        return {"mtimes": {}, "db": {}}
+    if not isinstance(cache, dict) or not {"mtimes", "db"} <= cache.keys():
+        return {"mtimes": {}, "db": {}}
+    return cache
+
+
+def write_index_cache(mtimes, database):
+    """Save the image index so the next run can skip re-scanning"""
+    temp = None
+    try:
+        os.makedirs(os.path.dirname(index_cache), exist_ok=True)
+        # write then rename, so a reader never sees half a file. The UI and a
+        # background reindex can both be here at once, so each gets its own.
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(index_cache))
+        with os.fdopen(fd, "wb") as file:
+            file.write(json_dumps({"mtimes": mtimes, "db": database}))
+        os.replace(temp, index_cache)
+    except OSError:
+        log(f"Could not write index cache to {index_cache}")
+        if temp is not None:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+
 def index_folder(folder):
-    """Get contents of all necessary files in remote settings folder"""
+    """Get contents of all necessary files in remote settings folder
+
+    Folders whose mtime matches the on-disk cache are not re-scanned, unless it
+    was too close to the last scan to be sure nothing changed after it.
+    """
     database = {}
-    top_level = os.listdir(folder)
-    folders = ["x", "xx", "xxx", "xxxx", "xxxxx"]
-    for each in folders:
-        if each in top_level:
-            new = os.listdir(folder + "/" + each)
-            if new == []:
-                continue
+    mtimes = {}
+    cache = read_index_cache()
+    scan_ns = time.time_ns()
+    with os.scandir(folder) as top_level:
+        present = {each.name: each for each in top_level if each.is_dir()}
+    for each in buckets:
+        if each not in present:
+            continue
+        # adding, removing, or renaming a file bumps the folder's mtime
+        mtime = present[each].stat().st_mtime_ns
+        if cache["mtimes"].get(each) == mtime:
+            new = cache["db"].get(each, [])
+        else:
+            # DirEntry already knows the file type from readdir, so this
+            # doesn't cost us an extra stat() per file
+            with os.scandir(folder + "/" + each) as contents:
+                new = [each1.name for each1 in contents
+                       if each1.is_file(follow_symlinks=False)
+                       and (each1.name.endswith(file_suffixes)
+                            or each1.name.lower().endswith(file_suffixes))]
+        if new:
             database[each] = new
-            for each1 in enumerate(database[each]):
-                if os.path.isdir(folder + "/" + each + "/" + each1[1]):
-                    del database[each][each1[0]]
-                if each1[1].split(".")[-1].lower() not in file_types:
-                    del database[each][each1[0]]
-    delete = []
-    for each in database:
-        if database[each] == []:
-            delete.append(each)
-    for each in delete:
-        del database[each]
-    size = 0
-    for each in database:
-        size += len(database[each])
-    return {"index": database, "size": size}
+        # a file added after we scanned, but in the same tick, wouldn't change
+        # the mtime. Only trust it next time if it's too old for that to happen.
+        if mtime < scan_ns - mtime_granularity:
+            mtimes[each] = mtime
+    if mtimes != cache["mtimes"]:
+        write_index_cache(mtimes, database)
+    return {"index": database,
+            "size": sum(len(each) for each in database.values())}
 
 
 def __mount__(device, path_dir):
     """Mount device at path
-    It would be much lighter weight to use ctypes to do this
-    But, that keeps throwing an 'Invalid Argument' error.
-    Calling Mount with check_call is the safer option.
+
+    Try the mount(2) syscall first, which doesn't cost us a fork of sudo and
+    mount(8). Unlike mount(8), it won't guess the filesystem type (that was the
+    'Invalid Argument' error we used to get), so try the likely ones in turn.
+    It also needs CAP_SYS_ADMIN, so fall back to sudo mount if we don't have it.
     """
-    with subprocess.Popen(["sudo", "mount", device, path_dir],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE) as pipe:
-        out = pipe.stderr.read().decode()
-    if "already mounted" in out:
+    for fstype in mount_fstypes:
+        if libc.mount(device.encode(), path_dir.encode(), fstype.encode(), 0, None) == 0:
+            return
+        err = get_errno()
+        # EINVAL: not this filesystem, ENODEV: kernel doesn't know this filesystem
+        if err not in (errno.EINVAL, errno.ENODEV):
+            break
+    if err == errno.EPERM:
+        return __sudo_mount__(device, path_dir)
+    if err == errno.EBUSY:
         raise Exception
-    if "does not exist" in out:
-        raise OSError
+    raise OSError(err, os.strerror(err))
+
+
+def __sudo_mount__(device, path_dir):
+    """Mount device at path using sudo and mount(8)"""
+    try:
+        result = subprocess.run(["sudo", "mount", device, path_dir],
+                                capture_output=True, timeout=10)
+    except subprocess.TimeoutExpired as err:
+        raise OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT)) from err
+    if result.returncode == 0:
+        return
+    message = result.stderr.decode(errors="replace").strip()
+    log(message)
+    # mount(8) exits 32 for every kind of failure, so we still need the message
+    # to tell "already mounted" apart. Anything else (sudo saying no, say) can't be that.
+    if result.returncode == 32 and b"already mounted" in result.stderr:
+        raise Exception
+    raise OSError(result.returncode, message)
+
+
+def watch_folders(folders):
+    """Get an inotify file descriptor for folders
+
+    It becomes readable once a file has finished being written to, or has been
+    moved into, any of them. Waiting on a half-copied picture would just get
+    us a GError when we try to show it.
+    """
+    in_close_write = 0x8
+    in_moved_to = 0x80
+    watch = libc.inotify_init1(os.O_CLOEXEC)
+    if watch == -1:
+        raise OSError(get_errno(), os.strerror(get_errno()))
+    for each in folders:
+        if libc.inotify_add_watch(watch, each.encode(), in_close_write | in_moved_to) == -1:
+            err = get_errno()
+            os.close(watch)
+            raise OSError(err, os.strerror(err), each)
+    return watch
 
 
 def __umount__(path_dir):
-    return subprocess.check_call(["sudo", "umount", path_dir])
-
-
-# This code handles auto-mounting and adaptive handling of that situation for PyPicFrame
-if "--no-fork" not in sys.argv:
-    # GUI_pid = os.fork()
-    GUI_pid = -1
-    log(f"Background process: {GUI_pid}")
-    if GUI_pid != 0:
-        # status indicator:
-        #   0: device not attached
-        #   1: device attached but not mounted
-        #   2: device attached and mounted
-        #
-        # These are only to be set AFTER handling the above status, but checked for
-        # before handling.
-        set_procname("ppf-mounter")
-
-
-        def restart_child(pid, options=[]):
-            if pid is not None:
-                try:
-                    os.kill(pid, 15)
-                    os.kill(pid, 9)
-                except ProcessLookupError:
-                    log(f"Process { pid } not found.")
-            command = [sys.argv[0], "--no-fork"]
-            if isinstance(options, list):
-                command = command + options
-            elif isinstance(options, str):
-                command.append(options)
-            log(command)
-            new_pid = subprocess.Popen(command).pid
-            return new_pid
-
-
-        status = 0
-        while True:
-            status_kernel = subprocess.check_output(["lsblk", "--json",
-                                                     "--output",
-                                                     "path,mountpoint"]).decode()
-            status_kernel = json.loads(status_kernel)["blockdevices"]
-            index = -1
-            for each in status_kernel:
-                if each["path"] == part:
-                    index = each
-                    break
-            if index == -1:
-                # device not attached. Handle.
-                if status == 2:
-                    __umount__("/mnt")
-                if status != 0:
-                    GUI_pid = restart_child(GUI_pid, "--no-device")
-                elif GUI_pid == -1:
-                    # Initialize with no device flag
-                    GUI_pid = restart_child(None, "--no-device")
-                status = 0
-                time.sleep(3)
-                continue
-            if "/mnt" != index["mountpoint"]:
-                # device attached but not mounted. Handle.
-                try:
-                    __mount__(part, "/mnt")
-                except OSError:
-                    # pass
-                    log("Drive not mountable.")
-                    time.sleep(3)
-                except Exception:
-                    log("Drive already mounted.")
-                if os.listdir("/mnt") == []:
-                    GUI_pid = restart_child(GUI_pid, "--setup")
-                    time.sleep(1)
-                status = 1
-                continue
-            if GUI_pid == -1:
-                # Initialize
-                GUI_pid = subprocess.Popen(sys.argv + ["--no-fork"]).pid
-                status = 2
-                continue
-            if status != 2:
-                # device NEWLY attached AND mounted. Handle.
-                GUI_pid = restart_child(GUI_pid)
-                status = 2
-                continue
-            time.sleep(2)
+    """Unmount path
+
+    Same as __mount__(), try umount2(2) first and only fork sudo umount if we
+    aren't allowed to.
+    """
+    if libc.umount2(path_dir.encode(), 0) == 0:
+        return
+    err = get_errno()
+    if err == errno.EPERM:
+        return subprocess.check_call(["sudo", "umount", path_dir])
+    raise OSError(err, os.strerror(err), path_dir)
+
+
+def get_mountpoint(device):
+    """Find where device is mounted, if anywhere
+
+    Reads the kernel's mount table directly, rather than forking lsblk for it.
+    """
+    with open("/proc/self/mountinfo", "r") as file:
+        for line in file:
+            fields = line.split()
+            # the optional fields vary in number, but always end with a lone
+            # "-". The mount source is the second field after it.
+            source = fields[fields.index("-", 6) + 2]
+            if source == device:
+                return fields[4]
+    return None
 
 
 def get_screen_res():
     """Get screen resolution"""
-    screen = Display(':0').screen()
-    return (int(screen.width_in_pixels), int(screen.height_in_pixels))
+    display = Gdk.Display.get_default()
+    monitor = display.get_primary_monitor() or display.get_monitor(0)
+    geometry = monitor.get_geometry()
+    return (geometry.width, geometry.height)
 
 
 class PyPicFrame(Gtk.Window):
-    """Main UI Window"""
-    def __init__(self, errors, image_index, image_override=None):
+    """Main UI Window
+
+    Also keeps an eye on the drive. It gets mounted when it's plugged in, and
+    we switch between pictures and the error screens as it comes and goes,
+    all without restarting.
+    """
+    def __init__(self, errors):
         """Initialize the Window"""
         Gtk.Window.__init__(self, title="PyPicFrame")
         self.grid = Gtk.Grid(orientation=Gtk.Orientation.VERTICAL)
         self.add(self.grid)
-        self.errors = []
-        self.image_index = image_index
+        # reuse one widget for every picture, rather than rebuilding it each time.
+        # It fills the window and keeps the picture centered in it, so the window
+        # can stay fullscreen whatever shape the picture is.
+        self.image = Gtk.Image(hexpand=True, vexpand=True)
+        self.grid.attach(self.image, 1, 1, 1, 1)
+        self.set_position(Gtk.WindowPosition.CENTER)
+        self.fullscreen()
+        self.error_names = errors["errors"]
+        self.image_index = {"index": {}, "size": 0}
         self.displayed_image = None
-        if ((image_index["size"] == 0) and (image_override is None)):
-            image_override = 2
-        if image_override not in (1, 3):
-            with open("/mnt/settings.json", "r") as file:
-                self.settings = json.load(file)
-        else:
-            log("Cannot find drive...")
-            with open("remote_data/settings.json", "r") as file:
-                self.settings = json.load(file)
-        self.settings["show_for"] *= 1000
-        self.grab_error_files(errors)
-        overridden = self.check_errors(image_override)
-        if overridden:
+        # asking X for this is a round trip, so only do it when it changes
+        self.screen_res = get_screen_res()
+        self.get_screen().connect("size-changed", self.refresh_screen_res)
+        # decode pictures off the UI thread, one ahead of what's on screen
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        self.next_image = None
+        # slideshow timer, only set while pictures are being shown
+        self.timer = None
+        # bumped every time the slideshow stops or starts, so anything still
+        # loading from before can tell it's out of date
+        self.generation = 0
+        # pictures in a row that we couldn't load
+        self.load_errors = 0
+        # drive re-scan, if one is running
+        self.reindex_future = None
+        # inotify fd and its GLib source, while waiting for pictures to show up
+        self.pic_watch = None
+        # only our drive coming and going can change what we show, so have the
+        # main loop wake us up when udev says something about it
+        self.udev_context = pyudev.Context()
+        self.udev_monitor = pyudev.Monitor.from_netlink(self.udev_context)
+        self.udev_monitor.filter_by("block")
+        self.udev_monitor.start()
+        self.udev_settle = None
+        GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, self.udev_monitor.fileno(),
+                              GLib.IOCondition.IN, self.udev_event, None)
+        # get an empty window up first. Everything else can happen once it's drawn.
+        GLib.idle_add(self.update_state)
+
+    def udev_event(self, fd, condition, user_data):
+        """Handle udev telling us about a block device"""
+        # plugging a drive in fires off a burst of add/change events. Let it
+        # settle so we only act on it once.
+        for device in iter(functools.partial(self.udev_monitor.poll, 0), None):
+            if device.device_node == part and self.udev_settle is None:
+                self.udev_settle = GLib.timeout_add(200, self.update_state)
+        return True
+
+    def update_state(self):
+        """Mount or unmount the drive as needed, then show whatever fits"""
+        self.udev_settle = None
+        try:
+            pyudev.Devices.from_device_file(self.udev_context, part)
+            attached = True
+        except (OSError, ValueError, pyudev.DeviceNotFoundError):
+            attached = False
+        if not attached:
+            # device not attached. Handle.
+            if get_mountpoint(part) == "/mnt":
+                try:
+                    __umount__("/mnt")
+                except (OSError, subprocess.CalledProcessError):
+                    log("Could not unmount /mnt.")
+            self.show_error(1)
+            return False
+        if get_mountpoint(part) != "/mnt":
+            # device attached but not mounted. Handle.
+            try:
+                __mount__(part, "/mnt")
+            except OSError:
+                log("Drive not mountable.")
+                self.show_error(1)
+                return False
+            except Exception:
+                log("Drive already mounted.")
+        elif self.timer is not None:
+            # already showing pictures from it. Nothing's changed.
+            return False
+        self.check_drive()
+        # only run once per idle_add()
+        return False
+
+    def check_drive(self):
+        """Show pictures from the mounted drive, or say why we can't"""
+        try:
+            self.image_index = index_folder("/mnt")
+        except OSError:
+            self.show_error(1)
             return
-        self.pick_pic()
-        GLib.timeout_add(self.settings["show_for"], self.pick_pic)
-
-    def grab_error_files(self, errors):
-        """Grab error files and pull them into memory"""
-        for each in errors["errors"]:
-            log(f"Grabbing errors/{each}")
-            image = GdkPixbuf.Pixbuf.new_from_file("errors/" + each)
-            image = scale(image)[0]
-            self.errors.append(image)
-
-    def check_errors(self, image_override):
-        """Window for PyPicFrame"""
-        if image_override is not None:
-            image = Gtk.Image.new_from_pixbuf(self.errors[image_override])
-            self.grid.remove_row(1)
-            self.grid.attach(image, 1, 1, 1, 1)
-            self.display()
+        if self.image_index["size"] >= min_pics:
+            self.resume()
+            return
+        try:
+            # check if folders exist
+            ls = set(os.listdir("/mnt"))
+            missing = [each for each in buckets if each not in ls]
+            need_settings = "settings.json" not in ls
+            if len(missing) + need_settings >= 5:
+                # a new drive. Say so, and set it up once that's on screen.
+                self.show_error(3)
+                GLib.idle_add(self.setup_drive)
+                return
+            for each in missing:
+                os.mkdir("/mnt/" + each)
+            if need_settings:
+                shutil.copyfile("remote_data/settings.json", "/mnt/settings.json")
+        except OSError as err:
+            # read-only (write protected SD adapters get mounted that way) or full
+            log(f"Could not set up drive: {err}")
+            self.show_error(1)
+            return
+        # the drive is set up, there's just nothing on it to show yet
+        self.show_error(2)
+        self.watch_pics()
+
+    def setup_drive(self):
+        """Put our folders and settings on a new drive"""
+        try:
+            if not os.path.exists("/mnt/README.txt"):
+                shutil.copyfile("remote_data/README.txt", "/mnt/README.txt")
+            if not os.path.exists("/mnt/settings.json"):
+                shutil.copyfile("remote_data/settings.json", "/mnt/settings.json")
+            # some of it may already be there from an earlier, interrupted setup
+            for each in bucket_dirs:
+                os.makedirs(each, exist_ok=True)
+        except OSError as err:
+            # read-only or full. Say so, and try again when udev next tells us
+            # something about the drive.
+            log(f"Could not set up drive: {err}")
+            self.show_error(1)
+            return False
+        self.check_drive()
+        # only run once per idle_add()
+        return False
+
+    def watch_pics(self):
+        """Wait for pictures to be copied onto the drive"""
+        try:
+            fd = watch_folders(bucket_dirs)
+        except OSError as err:
+            # the drive's gone, or we're out of inotify watches
+            log(f"Could not watch for new pictures: {err}")
+            self.show_error(1)
+            return
+        source = GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, fd, GLib.IOCondition.IN,
+                                       self.new_pics, None)
+        self.pic_watch = (fd, source)
+        # index after watching, so nothing copied in between gets missed
+        self.new_pics(fd, GLib.IOCondition(0), None)
+
+    def new_pics(self, fd, condition, user_data):
+        """Check for pictures once a file has landed in one of the folders"""
+        try:
+            if condition & GLib.IOCondition.IN:
+                os.read(fd, 4096)
+            self.image_index = index_folder("/mnt")
+        except OSError as err:
+            log(f"Could not check for new pictures: {err}")
+            # show_error() drops our watch, so GLib isn't left holding a dead one
+            self.show_error(1)
+            return False
+        # the first file of a big copy wakes us up. Keep watching until there's
+        # enough for pick_pic() to actually show something.
+        if self.image_index["size"] < min_pics:
             return True
+        self.resume()
         return False
 
+    def stop_watching_pics(self):
+        """Stop waiting on pictures being copied to the drive"""
+        if self.pic_watch is not None:
+            fd, source = self.pic_watch
+            self.pic_watch = None
+            GLib.source_remove(source)
+            os.close(fd)
+
+    def show_error(self, error):
+        """Stop the slideshow and show one of the error screens instead"""
+        self.pause()
+        self.stop_watching_pics()
+        # only the one error we're showing ever gets loaded
+        log(f"Grabbing errors/{self.error_names[error]}")
+        self.image.set_from_pixbuf(load_error(self.error_names[error], self.screen_res))
+
+    def resume(self):
+        """Start showing pictures from the drive"""
+        self.stop_watching_pics()
+        try:
+            self.settings = dict(load_json("/mnt/settings.json"))
+        except FileNotFoundError:
+            self.settings = dict(load_json("remote_data/settings.json"))
+        except json.decoder.JSONDecodeError:
+            log("Error reading /mnt/settings.json")
+            self.show_error(0)
+            return
+        self.settings["show_for"] *= 1000
+        # the drive may have changed since we last showed anything
+        load_pic.cache_clear()
+        self.pause()
+        self.load_errors = 0
+        self.weigh_pics()
+        self.pick_pic()
+        self.timer = GLib.timeout_add(self.settings["show_for"], self.pick_pic)
+
+    def pause(self):
+        """Stop the slideshow"""
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        self.next_image = None
+        self.generation += 1
+
     def pick_pic(self):
-        """Pick a random picture from the index. Replace displayed image with new image."""
+        """Show the picture loaded in the background, then start loading the next one"""
         # we only have, at most, one image to show. So don't change anything.
-        if self.image_index["size"] < 2:
+        if self.image_index["size"] < min_pics:
             return True
-        if self.settings["honor_rating"]:
-            num = rand.randint(1, 150)
-            num = round(num, -1) / 10
-            if num > 10:
-                num = 5
-            elif 6 < num <= 10:
-                num = 4
-            elif 3 < num <= 6:
-                num = 3
-            elif 1 < num <= 3:
-                num = 2
-            else:
-                num = 1
-        else:
-            num = rand.randint(1, 6)
-        string = "x" * num
-        try:
-            opts = self.image_index["index"][string]
-        except KeyError:
-            test = index_folder("/mnt")
-            if test["size"] == 0:
-                # the drive has likely been removed and has not been reinserted yet
-                # since we don't cache all the images into RAM, we can't do anything other
-                # than throw up an error since those are stored internally AND cached
-                self.restart()
-            # this MIGHT happen, but shouldn't. Essentially what is happening if we get here is that
-            # files changed on the drive while we weren't looking
-            self.image_index = test
-            return self.pick_pic()
-        if len(opts) > 1:
-            image = opts[rand.randint(0, len(opts) - 1)]
-        else:
-            image = opts[0]
-        path = "/mnt/" + string + "/" + image
+        if self.next_image is None:
+            self.next_image = self.queue_pic()
+        path, generation, future = self.next_image
+        # the swap itself has to happen on the UI thread
+        future.add_done_callback(
+            lambda done: GLib.idle_add(self.swap_image, path, generation, done))
+        self.next_image = self.queue_pic()
+        return True
+
+    def queue_pic(self):
+        """Pick a random picture from the index. Start loading it in the background.
+
+        Returns the picture's path, the slideshow generation it was picked in,
+        and the Future that will hold it once loaded.
+        """
         # make sure we don't just reset the image. Pick a new one each time.
-        if self.displayed_image == path:
-            return self.pick_pic()
+        # Loop rather than recurse, so a run of repeats can't exhaust the stack.
+        path = self.displayed_image
+        while path == self.displayed_image:
+            path = rand.choices(self.pic_paths, cum_weights=self.pic_weights)[0]
         self.displayed_image = path
         log(f"Chose: {path}")
-        # we know what image we want now. Now, remove the old one and use the new one
+        return (path, self.generation, self.pool.submit(load_pic, path, self.screen_res))
+
+    def swap_image(self, path, generation, future):
+        """Replace displayed image with a picture loaded by queue_pic()"""
+        if generation != self.generation:
+            # the slideshow has stopped (and maybe started again, with another
+            # drive) since this started loading
+            return False
         try:
-            image = GdkPixbuf.Pixbuf.new_from_file(path)
-        except gi.repository.GLib.GError:
-            self.image_index = index_folder("/mnt")
-            return self.pick_pic()
-        image = scale(image)
-        image[0] = Gtk.Image.new_from_pixbuf(image[0])
-        self.grid.remove_row(1)
-        self.grid.attach(image[0], 1, 1, 1, 1)
-        self.display(resolution=image[1])
-        return True
+            pixbuf = future.result()
+        except GLib.GError:
+            log(f"Could not load {path}")
+            self.drop_pic(path)
+            self.pick_pic()
+            return False
+        self.load_errors = 0
+        self.image.set_from_pixbuf(pixbuf)
+        # only run once per idle_add()
+        return False
+
+    def drop_pic(self, path):
+        """Take a picture we couldn't load out of the index
 
-    def display(self, resolution=get_screen_res()):
-        """handle show_all() calls"""
-        res = get_screen_res()
-        if (res[0] - 10) > resolution[0]:
-            self.unfullscreen()
+        One bad file shouldn't cost us a re-scan of the whole drive. But if
+        nothing has loaded for a while, the drive itself has probably gone.
+        """
+        self.load_errors += 1
+        if self.load_errors > 8:
+            self.load_errors = 0
+            self.reindex()
+            return
+        folder, name = path.split("/")[-2:]
+        opts = self.image_index["index"].get(folder, [])
+        if name in opts:
+            opts.remove(name)
+            self.image_index["size"] -= 1
+        if not opts:
+            self.image_index["index"].pop(folder, None)
+        self.weigh_pics()
+
+    def reindex(self):
+        """Re-scan the drive for pictures in the background
+
+        The current picture stays up until the scan is done.
+        """
+        if self.reindex_future is not None:
+            return
+        generation = self.generation
+        self.reindex_future = self.pool.submit(index_folder, "/mnt")
+        self.reindex_future.add_done_callback(
+            lambda done: GLib.idle_add(self.finish_reindex, generation, done))
+
+    def finish_reindex(self, generation, future):
+        """Switch over to the index built by reindex()"""
+        if self.reindex_future is future:
+            self.reindex_future = None
+        if generation != self.generation:
+            # the drive has been dealt with since. This scan is out of date.
+            return False
+        try:
+            self.image_index = future.result()
+        except OSError:
+            self.image_index = {"index": {}, "size": 0}
+        if self.image_index["size"] < min_pics:
+            # the drive has likely been removed and has not been reinserted yet
+            # since we don't cache all the images into RAM, we can't do anything other
+            # than throw up an error since those are stored internally AND cached
+            self.pause()
+            self.update_state()
+            return False
+        # don't show cached copies of files that might not be there anymore
+        load_pic.cache_clear()
+        self.weigh_pics()
+        # only run once per idle_add()
+        return False
+
+    def weigh_pics(self):
+        """Flatten the index into a list of paths, and how likely each one is
+        to be picked, so picking a picture is one rand.choices() call
+        """
+        if self.settings["honor_rating"]:
+            # how often each folder came up when rolling rand.randint(1, 150),
+            # rounding to the nearest ten, and bucketing the result
+            weights = (14, 20, 31, 40, 45)
         else:
-            self.fullscreen()
-        self.set_position(Gtk.WindowPosition.CENTER)
-        self.show_all()
+            weights = (1, 1, 1, 1, 1)
+        self.pic_paths = []
+        pic_weights = []
+        for key, path, weight in zip(buckets, bucket_dirs, weights):
+            opts = self.image_index["index"].get(key)
+            if not opts:
+                continue
+            # split the folder's weight between its pictures, so a folder
+            # stuffed with pictures isn't shown any more often than the rest
+            self.pic_paths.extend(path + each for each in opts)
+            pic_weights.extend(itertools.repeat(weight / len(opts), len(opts)))
+        # rand.choices() would otherwise add these up again on every pick
+        self.pic_weights = list(itertools.accumulate(pic_weights))
 
-    def restart(self):
-        """Exit"""
-        Gtk.main_quit("delete-event")
-        self.destroy()
-        subprocess.Popen([sys.argv[0]])
-        sys.exit()
+    def refresh_screen_res(self, screen):
+        """Update the cached screen resolution when a monitor is changed"""
+        self.screen_res = get_screen_res()
 
 
 
-def scale(image):
-    """Scale an image up or down depending on what's needed"""
-    screen_res = get_screen_res()
-    image_res = (image.get_width(), image.get_height())
+def scale(image_res, screen_res):
+    """Work out what size an image needs to be scaled up or down to"""
     # we have horizontal realestate to spare. If vertical realestate matches,
     # and horizontal realestate is equal to or greater than usable realestate,
     # return the image without modification
-    image = image.apply_embedded_orientation() # make sure the image is oriented correctly
     if (image_res[1] - 10) <= screen_res[1] <= (image_res[1] + 10):
         if image_res[0] <= screen_res[0]:
-            return [image, image_res]
+            return image_res
     # either the vertical realestate doesn't match, or the horizontal usage is
-    # greater than what we have, or both
-    # scale down situations first
-    if image_res[1] > screen_res[1]:
-        return scale_up(image, screen_res, image_res)
-    if image_res[0] > screen_res[0]:
-        return scale_down(image, screen_res, image_res)
-    if image_res[1] < screen_res[1]:
-        return scale_up(image, screen_res, image_res)
-
-
-def scale_down(image, screen_res, image_res):
-    """Scale images down"""
-    aspect_ratio_to_height = image_res[0] / image_res[1]
-    aspect_ratio_to_width = image_res[1] / image_res[0]
-    new_width = screen_res[1] * aspect_ratio_to_width
-    new_height = screen_res[0] * aspect_ratio_to_height
-    screen_area = screen_res[0] * screen_res[1]
-    new_height_area = screen_res[0] * new_height
-    new_width_area = screen_res[1] * new_width
-    new_height_wasted = abs(new_height_area - screen_area)
-    new_width_wasted = abs(new_width_area - screen_area)
-    if new_width_wasted <= new_height_wasted:
-        res = (new_width, screen_res[1])
-    else:
-        res = (screen_res[0], new_height)
-    return [image.scale_simple(res[0], res[1],
-                               GdkPixbuf.InterpType.BILINEAR), res]
+    # greater than what we have, or both. So scale the image up or down until it
+    # meets the edges of the screen. Comparing aspect ratios by cross
+    # multiplying keeps this in integers.
+    if image_res[0] * screen_res[1] <= image_res[1] * screen_res[0]:
+        # narrower than the screen, so height is what limits us
+        return ((image_res[0] * screen_res[1]) // image_res[1], screen_res[1])
+    return (screen_res[0], (image_res[1] * screen_res[0]) // image_res[0])
+
+
+# each cached picture is a full screen pixbuf, so 16 is roughly 100 MB at 1080p
+@functools.lru_cache(maxsize=settings.get("cache_size", 16))
+def load_pic(path, screen_res):
+    """Load an image from disk and scale it to fit the screen
+
+    Only the file's header is read to get its size, so the pixels can be
+    scaled while they are decoded instead of decoding at full resolution first.
+    This runs on PyPicFrame's worker threads, so it must not touch any widgets.
+    Recently shown pictures are kept in memory; call load_pic.cache_clear()
+    whenever the index is rebuilt.
+    """
+    file_format, width, height = GdkPixbuf.Pixbuf.get_file_info(path)
+    if file_format is None:
+        raise GLib.GError(f"Unrecognized image format: {path}")
+    res = scale((width, height), screen_res)
+    image = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, res[0], res[1], True)
+    # make sure the image is oriented correctly
+    image = image.apply_embedded_orientation()
+    # The header gives the size before rotation, so a photo taken sideways
+    # comes out the wrong shape for the screen. Fix that up with a second, much
+    # smaller, scale. Anything else should be within a pixel or so.
+    image_res = (image.get_width(), image.get_height())
+    if abs(image_res[0] - res[0]) > 10 or abs(image_res[1] - res[1]) > 10:
+        res = scale(image_res, screen_res)
+        if res != image_res:
+            image = image.scale_simple(res[0], res[1], GdkPixbuf.InterpType.BILINEAR)
+    return image
 
 
-def scale_up(image, screen_res, image_res):
-    """Scale images up"""
-    aspect_ratio = image_res[0] / image_res[1]
-    new_width = screen_res[1] * aspect_ratio
-    return [image.scale_simple(new_width, screen_res[1],
-                              GdkPixbuf.InterpType.BILINEAR),
-            (new_width, screen_res[1])]
+def load_error(name, screen_res):
+    """Load an error image, already scaled to fit the screen
+
+    Rasterizing the SVGs is slow on a Pi, and they never change, so the scaled
+    copy is kept as a PNG in our cache folder for next time.
+    """
+    path = "errors/" + name
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                             "pypicframe", "errors", f"{screen_res[0]}x{screen_res[1]}")
+    cached = os.path.join(cache_dir, name + ".png")
+    try:
+        # a newer error image means we've been updated. Don't show the old one.
+        if os.stat(cached).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return GdkPixbuf.Pixbuf.new_from_file(cached)
+    except (OSError, GLib.GError):
+        pass
+    image = load_pic(path, screen_res)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        image.savev(cached, "png", [], [])
+    except (OSError, GLib.GError):
+        log(f"Could not cache {cached}")
+    return image
 
 
-def show_window(errors, index, override):
+def show_window(errors):
     """Show Main UI"""
-    window = PyPicFrame(errors, index, image_override=override)
+    window = PyPicFrame(errors)
     window.set_decorated(False)
     window.set_resizable(False)
     window.show_all()
     Gtk.main()
 
 
-override=None
-if "--setup" in sys.argv:
-    override = 3
-elif "--no-device" in sys.argv:
-    override = 1
-
+# only one of us should be showing pictures at a time. The lock goes away with
+# our process, so a crash can't leave it stuck. It lives somewhere only we can
+# write to, so nobody else can hold it (or swap it for a symlink) to keep us out.
+if "XDG_RUNTIME_DIR" in os.environ:
+    pid_dir = os.environ["XDG_RUNTIME_DIR"]
+elif os.path.isdir(f"/run/user/{os.getuid()}"):
+    pid_dir = f"/run/user/{os.getuid()}"
+else:
+    # setup.sh makes this one ours
+    pid_dir = os.path.dirname(index_cache)
 try:
-    index_main = index_folder("/mnt")
-except OSError:
-    index_main = {}
-    override = 1
-index_errors = {"errors": ["json_error.svg", "no_drive.svg", "no_pics.svg", "new_drive.svg"]}
-if ((index_main["size"] == 0) and (override is None)):
-    # check if folders exist
-    ls = os.listdir("/mnt")
-    total = 0
-    string = "x"
-    for each in range(1, 6):
-        if (string * each) not in ls:
-            total += 1
-    if not os.path.exists("/mnt/settings.json"):
-        total += 1
-    if total >= 5:
-        override = 3
-    else:
-        for each in range(1, 6):
-            if (string * each) not in ls:
-                os.mkdir("/mnt/" + (string * each))
-        if not os.path.exists("/mnt/settings.json"):
-            shutil.copyfile("remote_data/settings.json", "/mnt/settings.json")
-
-log(str(override))
-log(str(sys.argv))
-if override == 3: # need to set up drive
-    log("FORKED!")
-    pid = os.fork()
-    """ from here, the CHILD needs to be the UI. The parent should set up the drive,
-    and once done, kill the child, recurse, then exit."""
-    if pid != 0:
-        set_procname("ppf-setup")
-        time.sleep(10)
-        # set up the drive
-        if not os.path.exists("/mnt/README.txt"):
-            shutil.copyfile("remote_data/README.txt", "/mnt/README.txt")
-        if not os.path.exists("/mnt/settings.json"):
-            shutil.copyfile("remote_data/settings.json", "/mnt/settings.json")
-        string = "x"
-        for each in range(1, 6):
-            os.mkdir("/mnt/" + (string * each))
-        os.kill(pid, 9)
-        subprocess.Popen([sys.argv[0]])
-        sys.exit()
-if override == 2: # drive is set up but nothing in Index
-    log("FORKED!")
-    pid = os.fork()
-    """ from here, the CHILD needs to be the UI. The parent should watch for images.
-    Once images are found, it should kill the child, recurse, then exit."""
-    if pid != 0:
-        while True:
-            index_main = index_folder("/mnt")
-            if index_main["size"] != 0:
-                break
-            time.sleep(3)
-        os.kill(pid, 9)
-        subprocess.Popen([sys.argv[0]])
-        sys.exit()
+    os.makedirs(pid_dir, exist_ok=True)
+    pid_fd = os.open(os.path.join(pid_dir, "pypicframe.pid"),
+                     os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+except OSError as err:
+    log(f"Could not open pid file in {pid_dir}: {err}")
+    sys.exit(2)
+try:
+    fcntl.flock(pid_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+except BlockingIOError:
+    log("Process found!")
+    sys.exit()
+os.ftruncate(pid_fd, 0)
+os.write(pid_fd, str(os.getpid()).encode())
+
 # hide the cursor so it doesn't show over the images
 if "--testing" not in sys.argv:
-    try:
-        subprocess.Popen(["xbanish", "-a"])
-    except subprocess.CalledProcessError:
-        log("xbanish has encountered an error and could not be run.")
-    except FileNotFoundError:
+    xbanish = shutil.which("xbanish")
+    if xbanish is None:
         log("xbanish not installed. Please install it to hide the cursor when images are displayed.")
+    else:
+        subprocess.Popen([xbanish, "-a"])
 
-# add a short delay so that the parent process can get the drive mounted
-time.sleep(3)
-for each in psutil.process_iter():
-    if each.name() == "ppf-main":
-        log("Process found!")
-        sys.exit()
 set_procname("ppf-main")
-show_window(index_errors, index_main, override)
+index_errors = {"errors": ["json_error.svg", "no_drive.svg", "no_pics.svg", "new_drive.svg"]}
+show_window(index_errors)
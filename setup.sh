@@ -24,6 +24,8 @@
 sudo groupadd mount
 sudo usermod -aG mount $(whoami)
 sudo mkdir /etc/pypicframe
+sudo mkdir -p /var/cache/pypicframe
+sudo chown $(whoami) /var/cache/pypicframe
 sudo ln -s "$PWD/remote_data" /etc/pypicframe/remote_data
 sudo ln -s "$PWD/errors" /etc/pypicframe/errors
 sudo ln -s "$PWD/internal_settings.json" /etc/pypicframe/internal_settings.json
@@ -31,5 +33,4 @@ sudo ln -s "$PWD/system_config/sudoers" /etc/sudoers.d/pypicframe
 sudo chown root:root /etc/sudoers.d/pypicframe
 sudo ln -s "$PWD/pypicframe.py" /usr/local/bin/pypicframe
 sudo ln -s "$PWD/system_config/pypicframe.desktop" /etc/xdg/autostart/pypicframe.desktop
-pip3 install dependencies/Python/*
-sudo apt install -y xbanish
+sudo apt install -y xbanish python3-pyudev
@@ -22,6 +22,7 @@
 #
 #
 sudo rm -rfv /etc/pypicframe
+sudo rm -rfv /var/cache/pypicframe
 sudo rm -rfv /usr/local/bin/pypicframe
 sudo rm -rfv /etc/xdg/autostart/pypicframe.desktop
 g=$(groups | sed 's/mount //g')